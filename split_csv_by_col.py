@@ -2,7 +2,12 @@
 """
 Script that splits a CSV file into multiple files based on the contents of a specified column.
 
-For large files, it is recommended to sort the input file by the column you want to split on.
+The input file does not need to be sorted by the column you want to split on: output
+files are kept open (up to a limit based on the number of open files allowed by the OS)
+so rows can be routed to the right file wherever they appear.
+
+Lines are split on the delimiter directly (no CSV quoting rules are applied) and are
+written to the output files exactly as they appear in the input.
 
 Input CSV file:
 
@@ -36,10 +41,44 @@ AF-A0A0A7M1B3-F1-model_v4_TED02	2.40.30.10	92.63	5o8wA02
 """
 
 
-import csv
-import re
+import functools
+import mmap
+import multiprocessing
+import os
+import string
+import threading
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import click
 
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+# large buffers mean far fewer read/write syscalls per MB processed
+IO_BUFFER_SIZE = 1 << 20
+
+# size at which the buffered lines for an output file are written to disk
+OUTPUT_FLUSH_SIZE = 256 * 1024
+
+# maximum number of buffers waiting to be written (per writer thread)
+MAX_PENDING_WRITES = 4
+
+# maximum number of output files to keep open at any one time
+MAX_OPEN_FILES = 512
+
+# file descriptors to leave free for the input file, stdio, etc
+RESERVED_FILE_DESCRIPTORS = 32
+
+# characters that are allowed in output filenames (everything else is removed)
+FILENAME_CHARS = string.ascii_letters + string.digits + "_.-"
+
+# every other byte (including all non-ascii bytes, whatever the encoding)
+_FILENAME_DELETE_BYTES = bytes(
+    byte for byte in range(256) if chr(byte) not in FILENAME_CHARS
+)
+
 
 @click.command()
 @click.option("-i", "input", required=True, help="input file")
@@ -63,8 +102,51 @@ import click
     "--use_headers", is_flag=True, default=True, help="use headers in input file"
 )
 @click.option("--delimiter", default="\t", help="CSV delimiter")
-@click.option("--force", is_flag=True, default=False, help="callously ignore warnings")
-def run(input, column, output_stub, output_suffix, delimiter, use_headers, force):
+@click.option(
+    "--two_pass",
+    is_flag=True,
+    default=False,
+    help="index the input first, then copy the lines for each field in bulk "
+    "(faster for input sorted on the column)",
+)
+@click.option(
+    "--threads",
+    type=click.IntRange(min=1),
+    default=1,
+    help="number of threads used to write output files (not used with --two_pass)",
+)
+@click.option(
+    "--processes",
+    type=click.IntRange(min=1),
+    default=1,
+    help="number of processes to split the input with (not used with --two_pass)",
+)
+@click.option(
+    "--quiet",
+    is_flag=True,
+    default=False,
+    help="only report the totals (not a message per output file)",
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    default=False,
+    hidden=True,
+    help="no longer used (input does not need to be sorted)",
+)
+def run(
+    input,
+    column,
+    output_stub,
+    output_suffix,
+    delimiter,
+    use_headers,
+    two_pass,
+    threads,
+    processes,
+    quiet,
+    force,
+):
 
     app = CsvSplitter(
         input_file=input,
@@ -73,7 +155,10 @@ def run(input, column, output_stub, output_suffix, delimiter, use_headers, force
         output_suffix=output_suffix,
         delimiter=delimiter,
         use_headers=use_headers,
-        force=force,
+        two_pass=two_pass,
+        threads=threads,
+        processes=processes,
+        quiet=quiet,
     )
     app.run()
 
@@ -91,7 +176,11 @@ class CsvSplitter:
         output_suffix,
         delimiter,
         use_headers,
-        force,
+        two_pass=False,
+        threads=1,
+        processes=1,
+        quiet=False,
+        max_open_files=None,
     ):
         self.input_file = input_file
         self.column = column
@@ -99,96 +188,583 @@ class CsvSplitter:
         self.output_suffix = output_suffix
         self.delimiter = delimiter
         self.use_headers = use_headers
-        self.force = force
+        self.two_pass = two_pass
+        self.threads = threads
+        self.processes = processes
+        self.quiet = quiet
+        # files closed by the writer threads can wait in the queue for a while
+        self.max_open_files = max_open_files or get_max_open_files(
+            reserved=RESERVED_FILE_DESCRIPTORS + threads * MAX_PENDING_WRITES
+        )
+
+        self._delimiter_bytes = delimiter.encode()
 
-        self._headers = None
-        self._last_field = None
-        self._records_by_field = dict()
-        self._out_fh = None
-        self._out_writer = None
+        # raw header line (including the line ending), copied as-is to each output file
+        self._header_bytes = None
+        self._records_by_field = defaultdict(int)
+        self._filename_for_field = dict()
+        # first field written to each output file (fields that are the same once
+        # sanitised for the filename share a file)
+        self._field_for_filename = dict()
+        self._writers = OrderedDict()
+        self._writer_pool = None
+
+        # set in worker processes, which write to part files rather than the final output
+        self._part = None
 
     def run(self):
 
-        with open(self.input_file, "r") as in_fh:
-            in_reader = get_csv_reader(in_fh, delimiter=self.delimiter)
-            if self.use_headers:
-                self._headers = next(in_reader)
+        with open(self.input_file, "rb", buffering=IO_BUFFER_SIZE) as in_fh:
+            if self.two_pass:
+                self.split_two_pass(in_fh)
+            elif self.processes > 1:
+                self.split_parallel(in_fh)
+            else:
+                self.split_lines(in_fh)
+
+            if not self.quiet:
+                for field, record_count in self._records_by_field.items():
+                    field_text = field.decode(errors="replace")
+                    click.echo(
+                        f" ... wrote {record_count} records (field: {field_text})"
+                    )
+
+            total_records = sum(self._records_by_field.values())
+            total_files = len(self._field_for_filename)
+
+            click.echo(f"Wrote {total_records} records to {total_files} files")
+            click.echo("Done")
 
-            current_field = None
-            for line_count, cols in enumerate(in_reader, 1):
-                current_field = cols[self.column - 1]
+    def split_lines(self, in_fh):
+        """
+        Reads the input line by line, appending each line to the output file for its field.
+        """
+        if self.use_headers:
+            self._header_bytes = next(in_fh)
 
-                # swap output writer when we encounter a different field
-                if current_field != self._last_field:
-                    if current_field in self._records_by_field:
-                        msg = f"Already seen field '{current_field}', you probably want to sort the input file before running this script (line: {line_count})"
-                        if self.force:
-                            click.echo(msg, err=True)
-                        else:
-                            raise KeyError(msg)
+        if self.threads > 1:
+            self._writer_pool = WriterPool(self.threads)
 
-                    self.close_output_file()
+        try:
+            self._records_by_field = split_stream(
+                in_fh, self.column, self._delimiter_bytes, self.get_output_file
+            )
+        finally:
+            self.close_output()
+
+    def split_parallel(self, in_fh):
+        """
+        Splits the input into byte ranges (on line boundaries) that are processed by
+        separate worker processes, then joins the part files written by each worker
+        into the final output files.
+        """
+        if self.use_headers:
+            self._header_bytes = in_fh.readline()
+
+        ranges = get_line_ranges(in_fh, in_fh.tell(), self.processes)
+
+        # records for each field written by each worker (None if the worker failed,
+        # in which case it has already removed its own part files)
+        part_records = [None] * len(ranges)
+        try:
+            with multiprocessing.Pool(len(ranges) or 1) as pool:
+                results = [
+                    pool.apply_async(_split_part, [(self, start, end, part)])
+                    for part, (start, end) in enumerate(ranges)
+                ]
+                # wait for every worker so that no part files are still being written
+                for result in results:
+                    result.wait()
+
+            for part, result in enumerate(results):
+                if result.successful():
+                    part_records[part] = result.get()
+            for result in results:
+                result.get()
+
+            for records_by_field in part_records:
+                for field, record_count in records_by_field.items():
+                    self._records_by_field[field] += record_count
+
+            filenames_by_part = [
+                {self.get_field_filename(field) for field in records_by_field}
+                for records_by_field in part_records
+            ]
+
+            for field in self._records_by_field:
+                out_file = self.get_field_filename(field)
+                if out_file in self._field_for_filename:
+                    continue
+
+                out_fh = self.init_output_file(out_file, field)
+                try:
+                    out_fh.flush()
+                    for part, filenames in enumerate(filenames_by_part):
+                        if out_file in filenames:
+                            append_file(out_fh.fd, get_part_filename(out_file, part))
+                finally:
+                    out_fh.close()
+        finally:
+            for part, records_by_field in enumerate(part_records):
+                if records_by_field is None:
+                    continue
+                for field in records_by_field:
+                    remove_file(get_part_filename(self.get_field_filename(field), part))
+
+    def split_range(self, start, end, part):
+        """
+        Splits the lines in the byte range `[start, end)` of the input into part files
+        (with no header), returning the number of lines written for each field.
+        """
+        self._part = part
+        with open(self.input_file, "rb", buffering=IO_BUFFER_SIZE) as in_fh:
+            in_fh.seek(start)
+
+            if self.threads > 1:
+                self._writer_pool = WriterPool(self.threads)
+
+            try:
+                try:
+                    self._records_by_field = split_stream(
+                        read_lines_until(in_fh, end),
+                        self.column,
+                        self._delimiter_bytes,
+                        self.get_output_file,
+                    )
+                finally:
+                    self.close_output()
+            except BaseException:
+                # the main process only cleans up after workers that succeed
+                for part_file in self._field_for_filename:
+                    remove_file(part_file)
+                raise
+
+        return self._records_by_field
+
+    def split_two_pass(self, in_fh):
+        """
+        Records the byte ranges of the lines for each field, then maps the input into
+        memory and writes each output file in one go from those ranges.
+        """
+        if self.use_headers:
+            self._header_bytes = in_fh.readline()
+
+        ranges_by_field, records_by_field = self.scan_field_ranges(in_fh)
+        if not ranges_by_field:
+            return
+
+        # fields that share an output file have their lines written in input order
+        ranges_by_filename = dict()
+        first_field_by_filename = dict()
+        for field, ranges in ranges_by_field.items():
+            out_file = self.get_field_filename(field)
+            if out_file in ranges_by_filename:
+                ranges_by_filename[out_file] = sorted(
+                    ranges_by_filename[out_file] + ranges
+                )
+            else:
+                ranges_by_filename[out_file] = ranges
+                first_field_by_filename[out_file] = field
+
+        with mmap.mmap(in_fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            with memoryview(mm) as view:
+                for out_file, ranges in ranges_by_filename.items():
+                    out_fh = self.init_output_file(
+                        out_file, first_field_by_filename[out_file]
+                    )
+                    try:
+                        for start, end in ranges:
+                            if end - start >= OUTPUT_FLUSH_SIZE:
+                                out_fh.write_through(view[start:end])
+                            else:
+                                out_fh.write(view[start:end])
+                    finally:
+                        out_fh.close()
+
+        self._records_by_field.update(records_by_field)
+
+    def scan_field_ranges(self, in_fh):
+        """
+        Returns the `(start, end)` byte ranges of the lines for each field from the
+        current position of `in_fh` (runs of adjacent lines with the same field become
+        a single range) and the number of lines for each field.
+        """
+        ranges_by_field = defaultdict(list)
+        records_by_field = defaultdict(int)
+
+        def add_run(field, start, end, record_count):
+            ranges_by_field[field].append((start, end))
+            records_by_field[field] += record_count
+
+        delimiter = self._delimiter_bytes
+        column = self.column
+        col_idx = column - 1
+
+        pos = in_fh.tell()
+        run_field = None
+        run_start = pos
+        run_count = 0
+        for raw_line in in_fh:
+            # same bounded split as `split_stream`
+            field = raw_line.split(delimiter, column)[col_idx].rstrip(b"\r\n")
+
+            if field != run_field:
+                if run_field is not None:
+                    add_run(run_field, run_start, pos, run_count)
+                run_field = field
+                run_start = pos
+                run_count = 0
+
+            run_count += 1
+            pos += len(raw_line)
+
+        if run_field is not None:
+            add_run(run_field, run_start, pos, run_count)
+
+        return ranges_by_field, records_by_field
+
+    def get_output_file(self, current_field):
+        """
+        Returns the open output file for this field (opening it if necessary).
+
+        Open files are kept in least-recently-used order so that the oldest one
+        can be closed when we hit `max_open_files`.
+        """
+        out_file = self.get_field_filename(current_field)
+        out_fh = self._writers.get(out_file)
+        if out_fh is not None:
+            self._writers.move_to_end(out_file)
+            return out_fh
+
+        if len(self._writers) >= self.max_open_files:
+            _, oldest_fh = self._writers.popitem(last=False)
+            oldest_fh.close()
+
+        out_fh = self.init_output_file(out_file, current_field)
+        self._writers[out_file] = out_fh
+        return out_fh
+
+    def close_output(self):
+        """
+        Closes all the output files and waits for any writer threads to finish.
+        """
+        try:
+            self.close_output_files()
+        finally:
+            if self._writer_pool:
+                writer_pool, self._writer_pool = self._writer_pool, None
+                writer_pool.shutdown()
+
+    def close_output_files(self):
+        # close every file before raising the first error (if any)
+        error = None
+        while self._writers:
+            _, out_fh = self._writers.popitem(last=False)
+            try:
+                out_fh.close()
+            except Exception as exc:
+                if error is None:
+                    error = exc
+        if error is not None:
+            raise error
+
+    def get_field_filename(self, current_field):
+        """
+        Returns the output filename for this field.
+
+        Different fields can give the same filename once sanitised (e.g. `a/b` and
+        `ab`), in which case their lines go to the same file.
+        """
+        out_file = self._filename_for_field.get(current_field)
+        if out_file is None:
+            out_file = get_output_filename(
+                self.output_stub,
+                protect_filename(current_field),
+                self.output_suffix,
+            )
+            # part files get joined up (after the header) by the main process
+            if self._part is not None:
+                out_file = get_part_filename(out_file, self._part)
+            self._filename_for_field[current_field] = out_file
+        return out_file
 
-                    self.init_output_file(current_field)
+    def init_output_file(self, out_file, current_field):
+        # files that were closed to free up a file handle, or that were started by
+        # another field with the same filename, get re-opened for appending
+        if out_file in self._field_for_filename:
+            return OutputFile(out_file, append=True, writer_pool=self._writer_pool)
 
-                self._records_by_field[current_field] += 1
+        self._field_for_filename[out_file] = current_field
 
-                self._out_writer.writerow(cols)
+        if self._part is None and not self.quiet:
+            field_text = current_field.decode(errors="replace")
+            click.echo(f"Writing to {out_file} (field: {field_text})")
 
-                self._last_field = current_field
+        out_fh = OutputFile(out_file, writer_pool=self._writer_pool)
 
-            self.close_output_file()
+        if self._part is None and self.use_headers and self._header_bytes:
+            out_fh.write(self._header_bytes)
 
-            total_records = sum(self._records_by_field.values())
-            total_files = len(self._records_by_field.keys())
+        return out_fh
 
-            click.echo(f"Wrote {total_records} records to {total_files} files")
-            click.echo("Done")
 
-    def close_output_file(self):
-        if self._last_field:
-            click.echo(
-                f" ... wrote {self._records_by_field[self._last_field]} records (field: {self._last_field})"
-            )
+def split_stream(in_fh, column, delimiter, get_output_file):
+    """
+    Writes each line of `in_fh` to the file returned by `get_output_file(field)`.
 
-        if self._out_fh:
-            self._out_fh.close()
+    This is the hot loop, so it is kept as a plain function with no attribute
+    lookups on the splitter (which also keeps it friendly to PyPy's JIT).
 
-    def init_output_file(self, current_field):
-        out_file = get_output_filename(
-            self.output_stub,
-            protect_filename(current_field),
-            self.output_suffix,
-        )
-        click.echo(f"Writing to {out_file} (field: {current_field})")
+    Returns the number of lines written for each field.
+    """
+    records_by_field = defaultdict(int)
+    col_idx = column - 1
+    last_field = None
+    last_field_count = 0
+    write = None
 
-        self._out_fh = open(out_file, "w")
-        self._out_writer = get_csv_writer(self._out_fh, delimiter=self.delimiter)
+    # when splitting on the first column, any line that starts with the current field
+    # followed by the delimiter belongs to the current field, so doesn't need splitting
+    last_field_prefix = None
 
-        if current_field not in self._records_by_field:
-            self._records_by_field[current_field] = 0
-            if self.use_headers and self._headers:
-                self._out_writer.writerow(self._headers)
+    for raw_line in in_fh:
+        if last_field_prefix and raw_line.startswith(last_field_prefix):
+            write(raw_line)
+            last_field_count += 1
+            continue
 
+        # only split as far as the column we need, the raw line is written as-is
+        # (the line ending is only stripped from the field, if it is the last column)
+        field = raw_line.split(delimiter, column)[col_idx].rstrip(b"\r\n")
 
-def get_csv_reader(filehandle, delimiter):
-    reader = csv.reader(filehandle, delimiter=delimiter)
-    return reader
+        # the current file is always the most recently used, so it can't have been
+        # closed since we last looked it up
+        if field != last_field:
+            if last_field is not None:
+                records_by_field[last_field] += last_field_count
+            write = get_output_file(field).write
+            last_field = field
+            last_field_count = 0
+            if col_idx == 0:
+                last_field_prefix = field + delimiter
 
+        write(raw_line)
 
-def get_csv_writer(filehandle, delimiter):
-    writer = csv.writer(filehandle, delimiter=delimiter, quoting=csv.QUOTE_MINIMAL)
-    return writer
+        last_field_count += 1
 
+    if last_field is not None:
+        records_by_field[last_field] += last_field_count
 
-def protect_filename(column_text):
-    filename = re.sub(r"[^0-9a-zA-Z_.\-]", "", column_text)
-    return filename
+    return records_by_field
+
+
+def _split_part(args):
+    # runs in a worker process (see `CsvSplitter.split_parallel`)
+    splitter, start, end, part = args
+    return splitter.split_range(start, end, part)
+
+
+def read_lines_until(in_fh, end):
+    """
+    Yields lines from the current position of `in_fh` until byte offset `end`.
+    """
+    pos = in_fh.tell()
+    if pos >= end:
+        return
+    for raw_line in in_fh:
+        yield raw_line
+        pos += len(raw_line)
+        if pos >= end:
+            return
+
+
+def get_line_ranges(in_fh, start, count):
+    """
+    Divides the input from `start` to the end of the file into (up to) `count`
+    `(start, end)` byte ranges of roughly equal size that begin at the start of a line.
+    """
+    size = os.fstat(in_fh.fileno()).st_size
+    chunk_size = max(1, (size - start) // count)
+
+    boundaries = [start]
+    for part in range(1, count):
+        # move to the start of the next line after the approximate boundary
+        in_fh.seek(max(start, start + part * chunk_size - 1))
+        in_fh.readline()
+        boundary = in_fh.tell()
+        if boundary > boundaries[-1] and boundary < size:
+            boundaries.append(boundary)
+    boundaries.append(size)
+
+    return [
+        (range_start, range_end)
+        for range_start, range_end in zip(boundaries, boundaries[1:])
+        if range_end > range_start
+    ]
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def append_file(out_fd, path):
+    """
+    Copies the contents of `path` to the end of `out_fd`, using `os.sendfile` where
+    the OS allows it (so the data does not pass through Python).
+    """
+    with open(path, "rb") as src_fh:
+        size = os.fstat(src_fh.fileno()).st_size
+        offset = 0
+        if hasattr(os, "sendfile"):
+            try:
+                while offset < size:
+                    sent = os.sendfile(out_fd, src_fh.fileno(), offset, size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+            except OSError:
+                # some platforms only support sending to a socket
+                pass
+
+        src_fh.seek(offset)
+        chunk = src_fh.read(IO_BUFFER_SIZE)
+        while chunk:
+            write_all(out_fd, chunk)
+            chunk = src_fh.read(IO_BUFFER_SIZE)
+
+
+class OutputFile:
+    """
+    Output file that collects lines in memory and writes them with `os.write`.
+
+    If a `WriterPool` is given, the writes (and the final close) are handed to
+    the pool rather than done in the calling thread.
+    """
+
+    def __init__(self, path, append=False, writer_pool=None):
+        flags = os.O_WRONLY | os.O_CREAT | (os.O_APPEND if append else os.O_TRUNC)
+        self.path = path
+        self.fd = os.open(path, flags, 0o666)
+        self._buffer = bytearray()
+        self._writer_pool = writer_pool
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= OUTPUT_FLUSH_SIZE:
+            self.flush()
+
+    def write_through(self, data):
+        """
+        Writes `data` straight to the file (after anything already buffered).
+        """
+        self.flush()
+        if self._writer_pool:
+            self._writer_pool.submit(self.path, write_all, self.fd, bytes(data))
+        else:
+            write_all(self.fd, data)
+
+    def flush(self):
+        if not self._buffer:
+            return
+        if self._writer_pool:
+            self._writer_pool.submit(self.path, write_all, self.fd, bytes(self._buffer))
+        else:
+            write_all(self.fd, self._buffer)
+        self._buffer.clear()
+
+    def close(self):
+        if self.fd is None:
+            return
+        try:
+            self.flush()
+        finally:
+            if self._writer_pool:
+                self._writer_pool.close_fd(self.path, self.fd)
+            else:
+                os.close(self.fd)
+            self.fd = None
+
+
+class WriterPool:
+    """
+    Threads that write output files in the background.
+
+    Each file is always written by the same thread (chosen by its path) so the
+    writes to any one file stay in order, while writes to different files can
+    overlap (the GIL is released during `os.write`).
+    """
+
+    def __init__(self, threads):
+        self._executors = [ThreadPoolExecutor(max_workers=1) for _ in range(threads)]
+        self._pending = threading.BoundedSemaphore(threads * MAX_PENDING_WRITES)
+        self._errors = []
+
+    def submit(self, key, func, *args):
+        if self._errors:
+            raise self._errors[0]
+        self._queue(key, func, *args)
+
+    def close_fd(self, key, fd):
+        """
+        Closes `fd` once its queued writes are done (even if a write has failed).
+        """
+        self._queue(key, os.close, fd)
+
+    def _queue(self, key, func, *args):
+        # wait for a slot so we don't buffer the whole input in memory
+        self._pending.acquire()
+        executor = self._executors[hash(key) % len(self._executors)]
+        future = executor.submit(func, *args)
+        future.add_done_callback(self._write_done)
+
+    def _write_done(self, future):
+        self._pending.release()
+        if future.exception() is not None:
+            self._errors.append(future.exception())
+
+    def shutdown(self):
+        for executor in self._executors:
+            executor.shutdown(wait=True)
+        if self._errors:
+            raise self._errors[0]
+
+
+def write_all(fd, data):
+    with memoryview(data) as view:
+        while view:
+            view = view[os.write(fd, view) :]
+
+
+def get_max_open_files(reserved=RESERVED_FILE_DESCRIPTORS):
+    """
+    Returns the number of output files that can safely be kept open at once.
+    """
+    if resource is None:
+        return MAX_OPEN_FILES
+
+    soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit == resource.RLIM_INFINITY:
+        return MAX_OPEN_FILES
+
+    return max(1, min(MAX_OPEN_FILES, soft_limit - reserved))
+
+
+@functools.lru_cache(maxsize=None)
+def protect_filename(column_bytes):
+    filename = column_bytes.translate(None, _FILENAME_DELETE_BYTES)
+    return filename.decode("ascii")
 
 
 def get_output_filename(output_stub, unique_field, suffix):
     return f"{output_stub}{unique_field}{suffix}"
 
 
+def get_part_filename(output_filename, part):
+    return f"{output_filename}.part{part}"
+
+
 if __name__ == "__main__":
     run()